@@ -1,8 +1,12 @@
+import json
+
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import class_mapper, ColumnProperty
 from sqlalchemy.orm.properties import RelationshipProperty
 from sqlalchemy.orm.collections import InstrumentedList
 from minisync.mixins.sqlalchemy import JsonSerializer
 from minisync.exceptions import PermissionError
+from minisync.trace import SqlTrace, currentTrace
 
 def requireUser(f):
     def inner(*args, **kwargs):
@@ -17,17 +21,157 @@ def _getAttributeNames(mapper_class):
             if isinstance(prop, ColumnProperty)]
 
 
+_key_names = {}
+
+def _getKeyNames(mapper_class, id_col_name=None):
+    """
+    Return:
+        key_names - a tuple of the names of the attrs that identify a row of mapper_class. Detected
+            from the mapper's primary key, in primary key order, unless id_col_name overrides it.
+    """
+    if id_col_name is not None:
+        return (id_col_name,) if isinstance(id_col_name, basestring) else tuple(id_col_name)
+    key_names = _key_names.get(mapper_class)
+    if key_names is None:
+        mapper = class_mapper(mapper_class)
+        key_names = tuple(mapper.get_property_by_column(col).key for col in mapper.primary_key)
+        _key_names[mapper_class] = key_names
+    return key_names
+
+def _getIdentity(attr_dict, key_names):
+    """
+    Return:
+        ident - a tuple of the key values in attr_dict, or None if it does not address a row by all of them
+    """
+    ident = tuple(attr_dict.get(key_name) for key_name in key_names)
+    if None in ident:
+        return None
+    return ident
+
+
+_fk_targets = {}
+
+def _getForeignKeyTargets(mapper_class, field):
+    """
+    Compile, once per mapper class and attr, the foreign key constraints on the column behind `field`.
+        A constraint may span several columns, in which case every one of them is needed to find
+        the referenced row.
+    Return:
+        targets - a list of (table, local_key_names, remote_col_names, pk_order) tuples. pk_order
+            lists the positions of the remote columns in the referenced table's primary key order,
+            or is None if the constraint does not reference the primary key.
+    """
+    cache_key = (mapper_class, field)
+    targets = _fk_targets.get(cache_key)
+    if targets is None:
+        targets = []
+        mapper = class_mapper(mapper_class)
+        for fk in getattr(mapper_class, field).property.columns[0].foreign_keys:
+            elements = fk.constraint.elements
+            local_key_names = tuple(mapper.get_property_by_column(element.parent).key for element in elements)
+            remote_col_names = tuple(element.column.name for element in elements)
+            table = fk.column.table
+            pk_col_names = [col.name for col in table.primary_key.columns]
+            pk_order = None
+            if sorted(pk_col_names) == sorted(remote_col_names):
+                pk_order = tuple(remote_col_names.index(col_name) for col_name in pk_col_names)
+            targets.append((table, local_key_names, remote_col_names, pk_order))
+        _fk_targets[cache_key] = targets
+    return targets
+
+
+# What a key in a changeset attr_dict resolves to. See _getChangesetSchema().
+_COLUMN, _TO_ONE, _TO_MANY, _RESERVED, _REJECT = range(5)
+_REJECTED = (_REJECT, None)
+_RESERVED_KEYS = ('_op',)
+
+_changeset_schemas = {}
+
+def _getChangesetSchema(mapper_class, id_col_name):
+    """
+    Compile, once per mapper class, the table that dispatches each key of an attr_dict.
+    Return:
+        schema - a dict mapping key to a (kind, child_class) tuple. Columns not listed in
+            __allow_update__ map to _REJECT, as does any key missing from the schema.
+    """
+    key_names = _getKeyNames(mapper_class, id_col_name)
+    cache_key = (mapper_class, key_names)
+    schema = _changeset_schemas.get(cache_key)
+    if schema is None:
+        schema = {}
+        allow_update = getattr(mapper_class, '__allow_update__', ())
+        for attr_name in _getAttributeNames(mapper_class):
+            schema[attr_name] = (_COLUMN if attr_name in allow_update else _REJECT, None)
+        for prop in class_mapper(mapper_class).iterate_properties:
+            if isinstance(prop, RelationshipProperty):
+                schema[prop.key] = (_TO_MANY if prop.uselist else _TO_ONE, prop.mapper.class_)
+        for attr_name in _RESERVED_KEYS + key_names:
+            schema[attr_name] = (_RESERVED, None)
+        _changeset_schemas[cache_key] = schema
+    return schema
+
+
+_direct_encoders = {}
+
+def _hasDirectEncoder(serializer_class):
+    """
+    JsonSerializer.encode() rebuilds the output of JsonSerializer.__call__ and to_serializable_dict.
+    Return:
+        - True if serializer_class encodes exactly what it serializes: it has its own encode(), or
+            inherits JsonSerializer's along with the methods it mirrors [False]
+    """
+    has_direct_encoder = _direct_encoders.get(serializer_class)
+    if has_direct_encoder is None:
+        def func(klass, name):
+            method = getattr(klass, name, None)
+            return getattr(method, 'im_func', method)
+        if func(serializer_class, 'encode') is None:
+            has_direct_encoder = False
+        elif func(serializer_class, 'encode') is not func(JsonSerializer, 'encode'):
+            has_direct_encoder = True
+        else:
+            has_direct_encoder = all(func(serializer_class, name) is func(JsonSerializer, name)
+                                     for name in ('__call__', 'to_serializable_dict'))
+        _direct_encoders[serializer_class] = has_direct_encoder
+    return has_direct_encoder
+
+
+# Bound parameters per batched lookup query. SQLite allows at most 999 by default.
+_LOOKUP_CHUNK_PARAMS = 900
+
+
 class Minisync(object):
     """
     """
     def __init__(self, db, serializer=JsonSerializer):
         self.db = db
         self.serializer = serializer(db)
+        self._table_classes = {}
+        self._handlers = {
+            _COLUMN: self._setColumn,
+            _TO_ONE: self._setToOne,
+            _TO_MANY: self._setToMany,
+        }
 
     def serialize(self, mapper_class_instance):
         return self.serializer(mapper_class_instance)
 
-    def __call__(self, mapper_class, property_dict, id_col_name='id', commit=True, user=None):
+    def encode(self, mapper_class_instance, fp=None, **kwargs):
+        """
+        Serialize straight to JSON. Same output as json.dumps(self.serialize(mapper_class_instance), **kwargs),
+            as bytes, or written to fp if given. A serializer that overrides what it serializes without
+            overriding encode() goes through json.dumps instead.
+        """
+        if _hasDirectEncoder(self.serializer.__class__):
+            return self.serializer.encode(mapper_class_instance, fp=fp, **kwargs)
+        data = json.dumps(self.serialize(mapper_class_instance), **kwargs)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if fp is None:
+            return data
+        fp.write(data)
+
+    def __call__(self, mapper_class, property_dict, id_col_name=None, commit=True, user=None):
         """
         Create, update or delete the instance of mapper_class represented by mapper_obj_dict.
             Builds up a list of changes in the databsae session and treats them as a single database unit of work.
@@ -36,12 +180,15 @@ class Minisync(object):
             property_dict - a dict, a JSON object whose keys are representations of the rows or relations
                               to sync. Ex: `email` or `user`
                               Values can be scalars or lists. Lists are turned into sqlalchemy.orm.collections.InstrumentedList objects.
-            [id_col_name] - a string, the name of the attr on mapper_class instances that should serve as an
-                            existential check (TODO: Support multi-column primary keys) ['id']
+            [id_col_name] - a string or tuple of strings, the name(s) of the attr(s) on mapper_class instances
+                            that should serve as an existential check. If None, each mapper class's primary
+                            key, which may span several columns, is used. [None]
             [commit] - a boolean, whether (True) or not (False) to commit the flushed objects. [False]
             [user] - a mapper class instance, the user as provided by the session backend [None]
         Usage:
             Pass `id` to update (delete=False) or delete (delete=True). Leave out `id` to create.
+            Rows with a multi-column primary key are addressed by all of their key columns; if no such
+            row exists, it is created with those key values. Giving only some of them is not allowed.
         Keys on mapper_class_dict or its embedded documents:
             [_op] - a string, one of {'delete', 'disassociate'} [None]
         Return:
@@ -55,12 +202,52 @@ class Minisync(object):
         """
         db = self.db
 
+        trace = currentTrace()
+        if trace is not None:
+            trace.phase = 'resolve'
+            trace.enter(mapper_class)
+        self._validate(mapper_class, property_dict, id_col_name)
         mapper_obj = self._resolveAndSet(mapper_class, property_dict, user=user, id_col_name=id_col_name)
+        if trace is not None:
+            trace.phase = 'flush'
         db.session.flush()
         if commit:
+            if trace is not None:
+                trace.phase = 'commit'
             db.session.commit()
         return mapper_obj
 
+    def traced(self, mapper_class, property_dict, explain=False, **kwargs):
+        """
+        Call Minisync with every SQL statement it emits captured, for debugging a slow changeset.
+            Only statements from the current thread are captured, so this is safe to use for a
+            single request in production.
+        Arguments:
+            mapper_class, property_dict - as for __call__
+            [explain] - a boolean, whether (True) or not (False) to run EXPLAIN on each distinct
+                statement once the call is done [False]
+            Any other keyword arguments are passed to __call__.
+        Return:
+            (mapper_obj, report) - the return value of __call__, and the dict returned by SqlTrace.report()
+        Raises:
+            PermissionError
+        """
+        connection = self.db.session.connection()
+        with SqlTrace(connection, resolve_table=self._getClassForTable) as trace:
+            mapper_obj = self(mapper_class, property_dict, **kwargs)
+        if explain:
+            if connection.closed:
+                # Committed. The plans will be the same on a new connection, which is released
+                # afterwards rather than left open in a session transaction.
+                trace.connection = connection.engine.connect()
+                try:
+                    trace.explain()
+                finally:
+                    trace.connection.close()
+            else:
+                trace.explain()
+        return mapper_obj, trace.report()
+
     def _create(self, mapper_class, attr_dict, user):
         """
         Add a mapper class instance to the current ORM session.
@@ -82,34 +269,109 @@ class Minisync(object):
 
     def _getOrCreateMapperObj(self, mapper_class, attr_dict, user, id_col_name):
         """
-        Retrieve a row corresponding to the given ID column if it exists, and create it in the session
+        Retrieve a row corresponding to the given ID column(s) if it exists, and create it in the session
             if not.
         Return:
             mapper_obj - a mapper class instance, the newly-created or just-retrieved mapper class instance
         Raises:
             PermissionError
         """
-        was_created = False
-        if id_col_name in attr_dict.keys():
-            existing_id = attr_dict.get(id_col_name)
-            mapper_obj = mapper_class()
-            query_obj = getattr(mapper_obj, 'query')
-            mapper_obj = query_obj.get(existing_id) if existing_id else None
-        else:
-            if not mapper_class.permit_create(attr_dict, user=user):
+        key_names = _getKeyNames(mapper_class, id_col_name)
+        ident = _getIdentity(attr_dict, key_names)
+        if ident is not None:
+            mapper_obj = mapper_class.query.get(ident)
+            # A single-column key names an existing row. A multi-column key is usually made of
+            # natural or foreign keys, and names the row to create if there is none.
+            if mapper_obj is not None or len(key_names) == 1:
+                return mapper_obj, False
+        elif len(key_names) == 1 and key_names[0] in attr_dict:
+            return None, False
+
+        if not mapper_class.permit_create(attr_dict, user=user):
+            raise PermissionError()
+        mapper_obj = self._create(mapper_class, attr_dict, user=user)
+        self._setKey(mapper_obj, key_names, attr_dict, user)
+        return mapper_obj, True
+
+    def _setKey(self, mapper_obj, key_names, attr_dict, user):
+        """
+        Set the key columns given in attr_dict on a newly-created mapper class instance.
+        Raises:
+            PermissionError
+        """
+        for key_name in key_names:
+            if key_name in attr_dict:
+                if not self._checkFkPermissions(mapper_obj, key_name, attr_dict[key_name], user, attr_dict):
+                    raise PermissionError()
+                setattr(mapper_obj, key_name, attr_dict[key_name])
+
+    def _prefetch(self, mapper_class, attr_dicts, id_col_name):
+        """
+        Load the existing rows addressed by attr_dicts into the session with batched queries, so that
+            resolving each attr_dict afterwards is an identity map lookup rather than a query.
+        Return:
+            rows - a list of the loaded mapper class instances. The identity map only holds weak
+                references, so the caller must keep this list alive while it resolves attr_dicts.
+        """
+        key_names = _getKeyNames(mapper_class, id_col_name)
+        mapper = class_mapper(mapper_class)
+        identity_map = self.db.session.identity_map
+        idents = []
+        seen = set()
+        for attr_dict in attr_dicts:
+            ident = _getIdentity(attr_dict, key_names)
+            if ident is None or ident in seen:
+                continue
+            seen.add(ident)
+            if mapper.identity_key_from_primary_key(list(ident)) not in identity_map:
+                idents.append(ident)
+        if len(idents) < 2:
+            return []
+
+        rows = []
+        attrs = [getattr(mapper_class, key_name) for key_name in key_names]
+        chunk_size = max(1, _LOOKUP_CHUNK_PARAMS // len(attrs))
+        for start in xrange(0, len(idents), chunk_size):
+            chunk = idents[start:start + chunk_size]
+            if len(attrs) == 1:
+                criterion = attrs[0].in_([ident[0] for ident in chunk])
+            else:
+                criterion = or_(*[and_(*[attr == val for attr, val in zip(attrs, ident)]) for ident in chunk])
+            rows.extend(mapper_class.query.filter(criterion).all())
+        return rows
+
+    def _validate(self, mapper_class, attr_dict, id_col_name):
+        """
+        Check every key of attr_dict and its embedded documents against the changeset schema
+            of its mapper class, so that a bad changeset is rejected before any database work.
+        Raises:
+            PermissionError
+        """
+        key_names = _getKeyNames(mapper_class, id_col_name)
+        if len(key_names) > 1 and _getIdentity(attr_dict, key_names) is None and \
+                any(attr_dict.get(key_name) is not None for key_name in key_names):
+            # A partial multi-column key addresses no one row
+            raise PermissionError()
+        schema = _getChangesetSchema(mapper_class, id_col_name)
+        for attr_name, attr_val in attr_dict.iteritems():
+            kind, child_class = schema.get(attr_name, _REJECTED)
+            if kind == _REJECT:
                 raise PermissionError()
-            mapper_obj = self._create(mapper_class, attr_dict, user=user)
-            was_created = True
-        return mapper_obj, was_created
+            elif kind == _TO_ONE:
+                # A 1-1 or M-1 relation takes one embedded document; there is nothing to resolve null to
+                if not isinstance(attr_val, dict):
+                    raise PermissionError()
+                self._validate(child_class, attr_val, id_col_name)
+            elif kind == _TO_MANY:
+                for child_attr_dict in attr_val:
+                    self._validate(child_class, child_attr_dict, id_col_name)
 
-    def _resolveAndSet(self, mapper_class, attr_dict, mapper_obj=None, user=None, id_col_name='id'):
+    def _resolveAndSet(self, mapper_class, attr_dict, mapper_obj=None, user=None, id_col_name=None):
         """
         Recursively resolve nested JSON objects of arbitrary depth into their corresponding
             mapper class instances and instrumented attributes.
             TODO: Do not add() changes on instrumented attributes or lists to the session.
         """
-        db = self.db
-
         # {D}: Delete
         # No need to proceed further (for example, for updates) if we are doing this
         op = attr_dict.get('_op', None)
@@ -119,32 +381,60 @@ class Minisync(object):
         # Get or {C}: Create
         if not mapper_obj:
             mapper_obj, _ = self._getOrCreateMapperObj(mapper_class, attr_dict, user, id_col_name)
+        schema = _getChangesetSchema(mapper_class, id_col_name)
         for attr_name, attr_val in attr_dict.iteritems():
-            # {U}: Update
-            if attr_name != id_col_name and attr_name in _getAttributeNames(mapper_obj.__class__):
-                # Terminal attribute - resolves to a column on the current mapper.
-                self._update(mapper_obj, attr_name, attr_val, user=user)
-            else: # Nonterminal - continue resolution with attribute name
-                name_or_relation = getattr(mapper_obj, attr_name)
-                relations_to_process = []
-                prop = getattr(mapper_class, attr_name)
-                if hasattr(prop, 'property') and isinstance(prop.property, RelationshipProperty):
-                    child_class = prop.property.mapper.class_
-                    if isinstance(name_or_relation, list):  # i-M relation
-                        [relations_to_process.append(child_attr_dict) for child_attr_dict in attr_val]
-                    else: # 1-1 or M-1
-                        relations_to_process.append(attr_val)
-                        name_or_relation = attr_name
-                    for child_attr_dict in relations_to_process:
-                        child_mapper_obj, was_created = self._getOrCreateMapperObj(child_class, child_attr_dict, user, id_col_name)
-                        # {A,D}: Associate or disassociate, if so instructed
-                        association_modified = self._handleRelation(mapper_obj, name_or_relation, child_mapper_obj, child_attr_dict, user)
-                        if was_created:
-                            name_or_relation.append(child_mapper_obj)
-                        if was_created or (not association_modified):
-                            self._resolveAndSet(child_class, child_attr_dict, child_mapper_obj, user=user)
+            kind, child_class = schema.get(attr_name, _REJECTED)
+            if kind == _REJECT:
+                raise PermissionError()
+            elif kind != _RESERVED:
+                self._handlers[kind](mapper_obj, attr_dict, attr_name, attr_val, child_class, user, id_col_name)
         return mapper_obj
 
+    def _setColumn(self, mapper_obj, attr_dict, attr_name, attr_val, child_class, user, id_col_name):
+        # {U}: Update
+        # Terminal attribute - resolves to a column on the current mapper.
+        self._update(mapper_obj, attr_name, attr_val, user=user, attr_dict=attr_dict)
+
+    def _setToOne(self, mapper_obj, attr_dict, attr_name, attr_val, child_class, user, id_col_name):
+        # 1-1 or M-1: the relation is named, and set on the parent
+        self._resolveRelations(mapper_obj, attr_name, child_class, [attr_val], user, id_col_name)
+
+    def _setToMany(self, mapper_obj, attr_dict, attr_name, attr_val, child_class, user, id_col_name):
+        # i-M: the relation is the parent's instrumented list
+        self._resolveRelations(mapper_obj, getattr(mapper_obj, attr_name), child_class, attr_val,
+                               user, id_col_name)
+
+    def _resolveRelations(self, mapper_obj, name_or_relation, child_class, child_attr_dicts, user, id_col_name):
+        """
+        Nonterminal - continue resolution with each embedded document of a relation.
+        Arguments:
+            mapper_obj - an obj, the mapper class instance that owns the relation
+            name_or_relation - an obj or str, the instrumented list of an i-M relation, or the name of
+                a 1-1 or M-1 relation
+            child_class - a class, the mapper class on the other side of the relation
+            child_attr_dicts - a list of dicts, the embedded documents to resolve
+            user - an obj, a mapper class instance corresponding to the current application user
+            id_col_name - a string or tuple of strings, the name(s) of the existential check attr(s)
+        """
+        trace = currentTrace()
+        if trace is not None:
+            outer_mapper_class = trace.enter(child_class)
+        # Keep the prefetched rows referenced until every child has been resolved
+        prefetched = self._prefetch(child_class, child_attr_dicts, id_col_name)
+        for child_attr_dict in child_attr_dicts:
+            child_mapper_obj, was_created = self._getOrCreateMapperObj(child_class, child_attr_dict, user, id_col_name)
+            # {A,D}: Associate or disassociate, if so instructed
+            association_modified = self._handleRelation(mapper_obj, name_or_relation, child_mapper_obj, child_attr_dict, user)
+            if was_created:
+                if isinstance(name_or_relation, InstrumentedList):
+                    name_or_relation.append(child_mapper_obj)
+                else:
+                    setattr(mapper_obj, name_or_relation, child_mapper_obj)
+            if was_created or (not association_modified):
+                self._resolveAndSet(child_class, child_attr_dict, child_mapper_obj, user=user, id_col_name=id_col_name)
+        if trace is not None:
+            trace.enter(outer_mapper_class)
+
     def _handleRelation(self, parent, name_or_relation, child, child_attr_dict, user):
         """
         Associate or disassociate a related object depending on what the client asked for.
@@ -167,7 +457,20 @@ class Minisync(object):
             return self._associate(parent, name_or_relation, child, child_attr_dict, user)
         return False
 
-    def _checkFkPermissions(self, mapper_obj, field, val, user):
+    def _getClassForTable(self, table):
+        """
+        Return:
+            associated_class - the mapper class whose table is `table`, or None if there is none
+        """
+        if table not in self._table_classes:
+            associated_class = None
+            for klass in self.db.Model._decl_class_registry.values():
+                if hasattr(klass, '__tablename__') and klass.__tablename__ == table.name:
+                    associated_class = klass
+            self._table_classes[table] = associated_class
+        return self._table_classes[table]
+
+    def _checkFkPermissions(self, mapper_obj, field, val, user, attr_dict=None):
         """
         Determine whether (True) or not (False) the given user is allowed to update
             the given foreign key relationship.
@@ -176,23 +479,38 @@ class Minisync(object):
             field - a string, the name of the relational attribute
             val - a type instance, the value of the relational attribute
             user - an obj, a mapper class instance corresponding to the current application user
+            [attr_dict] - a dict, the changeset `field` belongs to. Supplies the other columns of a
+                multi-column foreign key, which otherwise come from mapper_obj. [None]
         Return:
             - True if allowed [False]
         """
         # if the attribute is an fk, do associated_object.permit_update(...)
-        fks = getattr(mapper_obj.__class__, field).property.columns[0].foreign_keys
-        associated_class = None
-        for fk in fks:
-            table = fk.column.table.name
-            for klass in self.db.Model._decl_class_registry.values():
-                if hasattr(klass, '__tablename__') and klass.__tablename__ == table:
-                    associated_class = klass
-        if associated_class:
-            if not associated_class.query.get(val).permit_update({field: val}, user=user):
+        for table, local_key_names, remote_col_names, pk_order in \
+                _getForeignKeyTargets(mapper_obj.__class__, field):
+            associated_class = self._getClassForTable(table)
+            if not associated_class:
+                continue
+            vals = []
+            for key_name in local_key_names:
+                if key_name == field:
+                    vals.append(val)
+                elif attr_dict and key_name in attr_dict:
+                    vals.append(attr_dict[key_name])
+                else:
+                    vals.append(getattr(mapper_obj, key_name))
+            if None in vals:
+                # The foreign key does not reference a row
+                continue
+            if pk_order is not None:
+                associated_obj = associated_class.query.get(tuple(vals[i] for i in pk_order))
+            else:
+                associated_obj = associated_class.query.filter(
+                    and_(*[table.c[col_name] == v for col_name, v in zip(remote_col_names, vals)])).first()
+            if not (associated_obj and associated_obj.permit_update({field: val}, user=user)):
                 return False
         return True
 
-    def _update(self, mapper_obj, field, val, user, skip_perms=False):
+    def _update(self, mapper_obj, field, val, user, skip_perms=False, attr_dict=None):
         """
         Update a given field and value on a mapper class instance in the current ORM session.
         Arguments:
@@ -201,6 +519,7 @@ class Minisync(object):
             val - a type instance, the new value of the field
             user - an obj, a mapper class instance corresponding to the current application user
             [skip_perms] - a boolean, whether (True) or not (False) we should skip the permission check
+            [attr_dict] - a dict, the changeset `field` belongs to [None]
         Return:
             mapper_obj - an obj, a mapper class instance whose attribute value for the given field
                 has been updated with the given value.
@@ -209,7 +528,7 @@ class Minisync(object):
         """
         if not field in mapper_obj.__class__.__allow_update__:
             raise PermissionError()
-        allowed = self._checkFkPermissions(mapper_obj, field, val, user)
+        allowed = self._checkFkPermissions(mapper_obj, field, val, user, attr_dict)
         if not allowed:
             raise PermissionError()
 
@@ -5,3 +5,5 @@ class MinisyncError(Exception):
 class PermissionError(MinisyncError):
     pass
 
+class PartitionRolledBackError(MinisyncError):
+    pass
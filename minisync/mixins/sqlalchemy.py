@@ -1,4 +1,6 @@
 import datetime
+import json
+from json.encoder import encode_basestring, encode_basestring_ascii
 
 def rec_getattr(obj, attr):
     try:
@@ -8,6 +10,45 @@ def rec_getattr(obj, attr):
     return ret_attr
 
 
+# Pre-encoded key fragments, per mapper class and encoder options. See JsonSerializer._getLayout().
+_layouts = {}
+
+_INFINITY = float('inf')
+
+def _encodeFloat(value):
+    # As json.dumps writes floats, with its default allow_nan=True
+    if value != value:
+        return 'NaN'
+    elif value == _INFINITY:
+        return 'Infinity'
+    elif value == -_INFINITY:
+        return '-Infinity'
+    return repr(value)
+
+def _getScalarEncoders(encode_string):
+    """
+    Return:
+        - a dict mapping each exact scalar type to a function that returns its JSON, as json.dumps writes
+            it. JSONEncoder.encode() builds a new encoder for every non-string value, so it is only
+            used for types missing from this table.
+    """
+    return {
+        type(None): lambda value: 'null',
+        bool: lambda value: 'true' if value else 'false',
+        int: str,
+        long: str,
+        float: _encodeFloat,
+        str: encode_string,
+        unicode: encode_string,
+    }
+
+# Keyed by ensure_ascii
+_scalar_encoders = {
+    True: _getScalarEncoders(encode_basestring_ascii),
+    False: _getScalarEncoders(encode_basestring),
+}
+
+
 class JsonSerializer(object):
     __public__ = None
 
@@ -40,3 +81,79 @@ class JsonSerializer(object):
             d[attr_name] = self(attr_to_serialize)
         return d
 
+    def encode(self, attr, fp=None, sort_keys=False, separators=None, ensure_ascii=True):
+        """
+        Encode attr straight to JSON, without building the intermediate dicts and lists that
+            __call__ returns. The output is byte-identical to json.dumps(self(attr)) with the same options.
+        Arguments:
+            attr - a db.Model instance, a list, or a scalar
+            [fp] - a file-like object to write the JSON to [None]
+            [sort_keys], [separators], [ensure_ascii] - as for json.dumps
+        Return:
+            data - a bytes string of JSON, or None if it was written to fp
+        """
+        encoder = json.JSONEncoder(sort_keys=sort_keys, separators=separators, ensure_ascii=ensure_ascii)
+        chunks = []
+        self._encode(attr, encoder, _scalar_encoders[bool(ensure_ascii)], chunks)
+        data = ''.join(chunks)
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        if fp is None:
+            return data
+        fp.write(data)
+
+    def _getLayout(self, attr, encoder):
+        """
+        Return:
+            layout - a list of (attr_name, prefix) tuples, one per key of the object attr encodes to, in
+                the order json.dumps would write them. prefix is the pre-encoded JSON that comes before
+                the key's value, e.g. `{"id": ` for the first key.
+        """
+        cache_key = (attr.__class__, encoder.sort_keys, encoder.item_separator, encoder.key_separator,
+                     encoder.ensure_ascii)
+        layout = _layouts.get(cache_key)
+        if layout is None:
+            # Build the keys of a dict the same way to_serializable_dict does, so that they come out
+            # in the same order json.dumps iterates them.
+            d = {}
+            for attr_name in attr.__public__:
+                d[attr_name] = None
+            keys = sorted(d.keys()) if encoder.sort_keys else list(d.keys())
+            layout = []
+            for position, attr_name in enumerate(keys):
+                opener = '{' if position == 0 else encoder.item_separator
+                layout.append((attr_name, opener + encoder.encode(attr_name) + encoder.key_separator))
+            _layouts[cache_key] = layout
+        return layout
+
+    def _encode(self, attr, encoder, scalars, chunks):
+        """
+        Append the JSON for attr to chunks, following the same rules as __call__.
+        """
+        encode_scalar = scalars.get(attr.__class__)
+        if encode_scalar is not None:
+            chunks.append(encode_scalar(attr))
+        elif isinstance(attr, self.db.Model):
+            layout = self._getLayout(attr, encoder)
+            if not layout:
+                chunks.append('{}')
+                return
+            for attr_name, prefix in layout:
+                chunks.append(prefix)
+                # Look the value up exactly as to_serializable_dict does, to keep the output identical
+                self._encode(rec_getattr(self, attr_name), encoder, scalars, chunks)
+            chunks.append('}')
+        elif isinstance(attr, list):
+            if not attr:
+                chunks.append('[]')
+                return
+            opener = '['
+            for a in attr:
+                chunks.append(opener)
+                self._encode(a, encoder, scalars, chunks)
+                opener = encoder.item_separator
+            chunks.append(']')
+        elif isinstance(attr, datetime.datetime):
+            chunks.append(scalars[str](attr.isoformat()))
+        else:
+            chunks.append(encoder.encode(attr))
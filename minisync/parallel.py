@@ -0,0 +1,165 @@
+import multiprocessing
+from collections import OrderedDict
+
+from minisync import _getKeyNames, _getIdentity
+from minisync.exceptions import MinisyncError, PartitionRolledBackError
+
+# The Minisync instance owned by the current worker process, built by the pool initializer,
+# or the error that building it raised.
+_worker_sync = None
+_worker_error = None
+
+
+def rootIdentity(mapper_class, attr_dict, id_col_name=None):
+    """
+    The default partition key: the row that a changeset's root attr_dict addresses.
+    Return:
+        - A hashable key, or None if the changeset creates its root and so conflicts with nothing
+    """
+    ident = _getIdentity(attr_dict, _getKeyNames(mapper_class, id_col_name))
+    if ident is None:
+        return None
+    return (mapper_class.__module__, mapper_class.__name__, ident)
+
+
+def _portableError(e):
+    """
+    Errors travel back to the parent process by pickling. Minisync errors pickle cleanly;
+        anything else (e.g. a DBAPI error holding a cursor) is flattened into a MinisyncError.
+    """
+    if isinstance(e, MinisyncError):
+        return e
+    return MinisyncError('%s: %s' % (e.__class__.__name__, e))
+
+
+def _initWorker(setup):
+    global _worker_sync, _worker_error
+    # A pool initializer that raises kills its worker, and the pool respawns it forever. Keep the
+    # error instead, and report it for every changeset the worker is given.
+    try:
+        _worker_sync = setup()
+        # A forked worker inherits the parent's scoped session registry, and with it a session bound
+        # to the parent's engine. Drop it so this worker opens its own session on its own engine.
+        session = _worker_sync.db.session
+        if hasattr(session, 'registry'):
+            session.registry.clear()
+    except Exception as e:
+        _worker_error = _portableError(e)
+
+
+def _applyPartition(task):
+    """
+    Apply every changeset in a partition, in order, as a single unit of work.
+    Return:
+        - A list of (index, (result, error)) tuples, one per changeset in the partition
+    """
+    partition, id_col_name, load_user = task
+    if _worker_error is not None:
+        return [(index, (None, _worker_error)) for index, _, _ in partition]
+    sync = _worker_sync
+    session = sync.db.session
+
+    applied = []
+    try:
+        try:
+            user = load_user(sync) if load_user else None
+            for index, mapper_class, property_dict in partition:
+                applied.append(sync(mapper_class, property_dict, id_col_name=id_col_name,
+                                    commit=False, user=user))
+        except Exception as e:
+            session.rollback()
+            failed = len(applied)
+            results = []
+            for position, (index, _, _) in enumerate(partition):
+                if position == failed:
+                    results.append((index, (None, _portableError(e))))
+                else:
+                    results.append((index, (None, PartitionRolledBackError())))
+            return results
+
+        try:
+            session.commit()
+        except Exception as e:
+            # e.g. a deferred constraint or a locked database: no one changeset is to blame
+            session.rollback()
+            error = _portableError(e)
+            return [(index, (None, error)) for index, _, _ in partition]
+
+        # The partition is committed; a failure from here on belongs to its changeset alone
+        results = []
+        for (index, _, _), mapper_obj in zip(partition, applied):
+            try:
+                results.append((index, (sync.serialize(mapper_obj), None)))
+            except Exception as e:
+                session.rollback()
+                results.append((index, (None, _portableError(e))))
+        return results
+    finally:
+        # Serializing reads from the database. Release the connection, and its read transaction,
+        # rather than hold it until the worker's next task.
+        session.close()
+
+
+class ParallelMinisync(object):
+    """
+    Apply a batch of independent changesets across a pool of worker processes.
+    """
+    def __init__(self, setup, processes=None, partition_key=rootIdentity):
+        """
+        Arguments:
+            setup - a module-level callable, run once in each worker process. It must build a new engine
+                and session (e.g. a new Flask app with an app context pushed) and return a Minisync
+                instance bound to them.
+            [processes] - an int, the number of worker processes [multiprocessing.cpu_count()]
+            [partition_key] - a callable taking (mapper_class, attr_dict, id_col_name) and returning a
+                hashable key. Changesets with equal keys conflict, so they are applied by the same worker
+                in input order. None means the changeset conflicts with nothing. [rootIdentity]
+        """
+        self.setup = setup
+        self.processes = processes
+        self.partition_key = partition_key
+
+    def _partition(self, changesets, id_col_name):
+        partitions = OrderedDict()
+        for index, (mapper_class, property_dict) in enumerate(changesets):
+            key = self.partition_key(mapper_class, property_dict, id_col_name)
+            if key is None:
+                key = ('_unkeyed', index)
+            partitions.setdefault(key, []).append((index, mapper_class, property_dict))
+        return list(partitions.values())
+
+    def __call__(self, changesets, id_col_name=None, load_user=None):
+        """
+        Arguments:
+            changesets - a list of (mapper_class, property_dict) tuples, as would be passed to Minisync()
+            [id_col_name] - a string or tuple of strings, passed through to Minisync() [None]
+            [load_user] - a module-level callable, called in the worker with its Minisync instance, that
+                returns the user to apply changesets as [None]
+        Return:
+            results - a list of (result, error) tuples in the order of `changesets`. On success, result is
+                the serialized object (True for a delete) and error is None. On failure, result is None
+                and error is a MinisyncError.
+        Transactional guarantees:
+            Each partition is a single unit of work, committed once all of its changesets have been applied.
+            If a changeset fails, its whole partition is rolled back: the failing changeset reports its own
+            error and the rest of the partition reports PartitionRolledBackError. If the commit itself fails,
+            every changeset in the partition reports the commit error.
+            Partitions commit independently of one another. A changeset that was committed but could not
+            be serialized reports the serialization error.
+        """
+        partitions = self._partition(changesets, id_col_name)
+        results = [None] * len(changesets)
+        tasks = [(partition, id_col_name, load_user) for partition in partitions]
+
+        pool = multiprocessing.Pool(self.processes, _initWorker, (self.setup,))
+        try:
+            for partition_results in pool.imap_unordered(_applyPartition, tasks):
+                for index, result in partition_results:
+                    results[index] = result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return results
@@ -0,0 +1,222 @@
+import threading
+import time
+import weakref
+
+from sqlalchemy import event
+
+_local = threading.local()
+_traced_connections = weakref.WeakSet()
+
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE')
+
+
+def currentTrace():
+    """
+    Return:
+        trace - the SqlTrace active on the current thread, or None
+    """
+    return getattr(_local, 'trace', None)
+
+
+def _beforeCursorExecute(conn, cursor, statement, parameters, context, executemany):
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace._record(statement, parameters, executemany, context)
+
+
+def _afterCursorExecute(conn, cursor, statement, parameters, context, executemany):
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace._finish()
+
+
+def _commit(conn):
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace._record('COMMIT', None, False, None)
+        trace._finish()
+
+
+def _listen(connection):
+    """
+    Install the trace listeners on a connection, once. A Connection only picks up listeners added to
+        its Engine before it was created, and SQLAlchemy cannot remove listeners, so they go on the
+        connection itself: they are discarded along with it, and do nothing while no trace is active.
+    """
+    if connection not in _traced_connections:
+        event.listen(connection, 'before_cursor_execute', _beforeCursorExecute)
+        event.listen(connection, 'after_cursor_execute', _afterCursorExecute)
+        event.listen(connection, 'commit', _commit)
+        _traced_connections.add(connection)
+
+
+class SqlTrace(object):
+    """
+    Capture the SQL statements emitted on a connection by the current thread while the trace is
+        active, tagged with the Minisync phase and mapper class that caused them. Nothing else is
+        traced, so a trace can be turned on for a single request in production.
+    Usage:
+        with SqlTrace(db.session.connection()) as trace:
+            ...
+        trace.report()
+    """
+    def __init__(self, connection, resolve_table=None, max_statements=1000):
+        """
+        Arguments:
+            connection - a Connection, the connection to capture statements from, e.g. the one
+                the session is using
+            [resolve_table] - a callable taking a Table and returning its mapper class or None. Used to
+                tag INSERT, UPDATE and DELETE statements with the mapper class they write to. [None]
+            [max_statements] - an int, the number of statements to keep. Any more are counted in
+                the report's `dropped`. [1000]
+        """
+        self.connection = connection
+        self.resolve_table = resolve_table
+        self.max_statements = max_statements
+        self.phase = None
+        self.mapper_class = None
+        self.statements = []
+        self.plans = {}
+        self.dropped = 0
+        self._outer = None
+        self._started = None
+
+    def __enter__(self):
+        _listen(self.connection)
+        self._outer = currentTrace()
+        _local.trace = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _local.trace = self._outer
+        self._outer = None
+
+    def enter(self, mapper_class):
+        """
+        Tag statements with mapper_class until the returned mapper class is entered again.
+        """
+        outer_mapper_class, self.mapper_class = self.mapper_class, mapper_class
+        return outer_mapper_class
+
+    def _getMapperName(self, context):
+        mapper_class = self.mapper_class
+        table = getattr(getattr(getattr(context, 'compiled', None), 'statement', None), 'table', None)
+        if table is not None and self.resolve_table:
+            mapper_class = self.resolve_table(table) or mapper_class
+        return mapper_class.__name__ if mapper_class else None
+
+    def _record(self, statement, parameters, executemany, context):
+        self._started = None
+        if len(self.statements) >= self.max_statements:
+            self.dropped += 1
+            return
+        self.statements.append({
+            'phase': self.phase,
+            'mapper': self._getMapperName(context),
+            'statement': statement,
+            'parameters': parameters,
+            'executemany': executemany,
+            'duration': None,
+        })
+        self._started = time.time()
+
+    def _finish(self):
+        if self._started is not None:
+            self.statements[-1]['duration'] = time.time() - self._started
+            self._started = None
+
+    def explain(self):
+        """
+        Run EXPLAIN (EXPLAIN QUERY PLAN on SQLite) once for each distinct statement captured, on a raw
+            cursor of the traced connection, so the EXPLAIN statements themselves are not captured.
+            A statement that cannot be explained gets an error message in place of its plan.
+            Each EXPLAIN runs in a savepoint that is rolled back afterwards, because on e.g. PostgreSQL
+            a failed statement aborts the whole transaction. SQLite needs no savepoint: a failed
+            statement leaves its transaction intact, and pysqlite does not track transactions that a
+            SAVEPOINT opens.
+        """
+        dbapi_connection = self.connection.connection
+        if self.connection.dialect.name == 'sqlite':
+            prefix = 'EXPLAIN QUERY PLAN '
+            use_savepoint = False
+        else:
+            prefix = 'EXPLAIN '
+            use_savepoint = True
+        for record in self.statements:
+            statement = record['statement']
+            if statement in self.plans or not statement.lstrip().upper().startswith(_EXPLAINABLE):
+                continue
+            parameters = record['parameters']
+            if record['executemany']:
+                parameters = parameters[0]
+            savepoint = self.connection.begin_nested() if use_savepoint else None
+            cursor = dbapi_connection.cursor()
+            try:
+                cursor.execute(prefix + statement, parameters)
+                self.plans[statement] = {'plan': [tuple(row) for row in cursor.fetchall()]}
+            except Exception as e:
+                self.plans[statement] = {'error': '%s: %s' % (e.__class__.__name__, e)}
+            finally:
+                cursor.close()
+                if savepoint is not None:
+                    savepoint.rollback()
+
+    def report(self):
+        """
+        Return:
+            report - a dict with the following keys:
+                statements - a list of dicts, every captured statement in order, with its phase, mapper,
+                    parameters and duration in seconds
+                phases - a dict mapping phase to its statement count and total duration
+                distinct - a list of dicts, each distinct statement text with its count, total duration,
+                    mappers and, if explain() was run, its plan or error
+                duplicates - a list of dicts, statements run more than once with the same parameters
+                repeated_gets - a list of dicts, SELECTs run more than once with different parameters.
+                    One query.get per row has this shape.
+                dropped - an int, the number of statements past max_statements that were not kept
+        """
+        phases = {}
+        distinct = {}
+        distinct_order = []
+        executions = {}
+        for record in self.statements:
+            statement = record['statement']
+            duration = record['duration'] or 0
+
+            phase = phases.setdefault(record['phase'], {'count': 0, 'duration': 0})
+            phase['count'] += 1
+            phase['duration'] += duration
+
+            if statement not in distinct:
+                distinct[statement] = {'statement': statement, 'count': 0, 'duration': 0, 'mappers': []}
+                distinct[statement].update(self.plans.get(statement, {}))
+                distinct_order.append(statement)
+            entry = distinct[statement]
+            entry['count'] += 1
+            entry['duration'] += duration
+            if record['mapper'] not in entry['mappers']:
+                entry['mappers'].append(record['mapper'])
+
+            executions.setdefault(statement, {})
+            params_key = repr(record['parameters'])
+            executions[statement][params_key] = executions[statement].get(params_key, 0) + 1
+
+        duplicates = []
+        repeated_gets = []
+        for statement in distinct_order:
+            entry = distinct[statement]
+            for params_key, count in executions[statement].iteritems():
+                if count > 1 and statement != 'COMMIT':
+                    duplicates.append({'statement': statement, 'parameters': params_key, 'count': count})
+            if len(executions[statement]) > 1 and statement.lstrip().upper().startswith('SELECT'):
+                repeated_gets.append({'statement': statement, 'count': entry['count'],
+                                      'mappers': entry['mappers']})
+
+        return {
+            'statements': self.statements,
+            'phases': phases,
+            'distinct': [distinct[statement] for statement in distinct_order],
+            'duplicates': duplicates,
+            'repeated_gets': repeated_gets,
+            'dropped': self.dropped,
+        }
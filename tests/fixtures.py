@@ -50,6 +50,23 @@ class ChildThingData(DataSet):
         thing_id = 3
         description = "Blergh"
 
+class ThingLabelData(DataSet):
+
+    class thing_label01:
+        thing_id = 1
+        name = "red"
+        color = "#f00"
+
+    class thing_label02:
+        thing_id = 1
+        name = "blue"
+        color = "#00f"
+
+    class thing_label03:
+        thing_id = 3
+        name = "green"
+        color = "#0f0"
+
 # A simple trick for installing all fixtures from an external module.
-all_data = (SyncUserData, ThingData, ChildThingData,)
+all_data = (SyncUserData, ThingData, ChildThingData, ThingLabelData,)
 
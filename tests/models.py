@@ -23,6 +23,7 @@ class Thing(db.Model):
                                     cascade='delete', backref=db.backref('parent'))
     only_child =    db.relationship('ChildThing', primaryjoin='ChildThing.parent_id == Thing.id',
                                     uselist=False, backref=db.backref('only_parent', uselist=False))
+    labels =        db.relationship('ThingLabel', cascade='delete', backref=db.backref('thing'))
 
     @staticmethod
     @requireUser
@@ -65,6 +66,53 @@ class ChildThing(db.Model):
         owned = user.id == parent.user_id
         return allowed and owned
 
+class ThingLabel(db.Model):
+    __tablename__ = "thing_labels"
+    __allow_update__ = ["color"]
+    thing_id =      db.Column(db.Integer, db.ForeignKey('things.id', deferrable=True, ondelete='CASCADE'), primary_key=True)
+    name =          db.Column(db.String(80), primary_key=True)
+    color =         db.Column(db.String(80))
+    notes =         db.relationship('LabelNote', cascade='delete', backref=db.backref('label'))
+
+    @staticmethod
+    @requireUser
+    def permit_create(obj_dict, user=None):
+        return True
+
+    @requireUser
+    def permit_update(self, obj_dict, user=None):
+        return user.id == self.thing.user_id
+
+class LabelNote(db.Model):
+    __tablename__ = "label_notes"
+    __table_args__ = (db.ForeignKeyConstraint(['thing_id', 'label_name'],
+                                              ['thing_labels.thing_id', 'thing_labels.name'],
+                                              ondelete='CASCADE'),)
+    __allow_update__ = ["text", "thing_id", "label_name"]
+    __allow_associate__ = ['ThingLabel']
+    __allow_disassociate__ = ['ThingLabel']
+    id =            db.Column(db.Integer, primary_key=True)
+    thing_id =      db.Column(db.Integer)
+    label_name =    db.Column(db.String(80))
+    text =          db.Column(db.Text)
+
+    @staticmethod
+    @requireUser
+    def permit_create(obj_dict, user=None):
+        return True
+
+    @requireUser
+    def permit_update(self, obj_dict, user=None):
+        return True
+
+    @requireUser
+    def permit_associate(self, parent, obj_dict, user=None):
+        return user.id == parent.thing.user_id
+
+    @requireUser
+    def permit_disassociate(self, parent, user=None):
+        return user.id == parent.thing.user_id
+
 class SyncUser(db.Model):
     __tablename__ = "users"
 
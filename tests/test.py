@@ -1,3 +1,6 @@
+import datetime
+import io
+import json
 import os
 
 from unittest import TestCase
@@ -12,6 +15,53 @@ import unittest
 import fixtures
 import models
 from minisync import Minisync, PermissionError
+from minisync.exceptions import PartitionRolledBackError
+from minisync.mixins.sqlalchemy import JsonSerializer
+from minisync.parallel import ParallelMinisync
+
+def parallel_setup():
+    # Runs in each worker process: a fresh app gives the worker its own engine and session.
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + os.getcwd() + "/tests.db"
+    models.db.init_app(app)
+    app.app_context().push()
+    return Minisync(models.db)
+
+class BrokenSerializer(JsonSerializer):
+
+    def __call__(self, attr):
+        raise ValueError('Cannot serialize')
+
+class DescribingSerializer(JsonSerializer):
+
+    def to_serializable_dict(self, attr, props=None):
+        return {'id': attr.id, 'description': attr.description}
+
+class PlainSerializer(object):
+
+    def __init__(self, db):
+        self.db = db
+
+    def __call__(self, attr):
+        return [a.id for a in attr] if isinstance(attr, list) else attr.id
+
+def parallel_broken_serializer_setup():
+    sync = parallel_setup()
+    sync.serializer = BrokenSerializer(sync.db)
+    return sync
+
+def parallel_broken_commit_setup():
+    sync = parallel_setup()
+    def commit():
+        raise RuntimeError('Database is locked')
+    sync.db.session.commit = commit
+    return sync
+
+def parallel_broken_setup():
+    raise RuntimeError('No database configured')
+
+def parallel_load_user(sync):
+    return models.SyncUser.query.get(1)
 
 class ModelsTestCase(TestCase):
 
@@ -50,6 +100,38 @@ class ModelsTestCase(TestCase):
         obj = self.sync.serialize(new_thing)
         assert obj == {'id': None}
 
+    def test_encode(self):
+        new_thing = self.sync(models.Thing, {'user_id': 1, 'description': "Hello."}, user=self.user)
+        self.assertEqual(self.sync.encode(new_thing), json.dumps(self.sync.serialize(new_thing)))
+        things = models.Thing.query.all()
+        self.assertEqual(self.sync.encode(things), json.dumps(self.sync.serialize(things)))
+        self.assertEqual(self.sync.encode([]), '[]')
+
+    def test_encode_scalars(self):
+        scalars = [None, True, False, 7, 10 ** 20, 1.5, float('nan'), float('inf'), u'caf\xe9 "x"', 'x',
+                   datetime.datetime(2013, 7, 1, 12, 30), {'a': [1, 2]}, (3, 4)]
+        for kwargs in ({}, {'ensure_ascii': False}, {'separators': (',', ':')}):
+            expected = json.dumps(self.sync.serialize(scalars), **kwargs)
+            if isinstance(expected, unicode):
+                expected = expected.encode('utf-8')
+            self.assertEqual(self.sync.encode(scalars, **kwargs), expected)
+
+    def test_encode_custom_serializer(self):
+        things = models.Thing.query.all()
+        for serializer in (DescribingSerializer, PlainSerializer):
+            sync = Minisync(self.db, serializer=serializer)
+            self.assertEqual(sync.encode(things), json.dumps(sync.serialize(things)))
+            fp = io.BytesIO()
+            sync.encode(things, fp=fp, sort_keys=True)
+            self.assertEqual(fp.getvalue(), json.dumps(sync.serialize(things), sort_keys=True))
+
+    def test_encode_to_file(self):
+        things = models.Thing.query.all()
+        fp = io.BytesIO()
+        self.sync.encode(things, fp=fp, sort_keys=True, separators=(',', ':'))
+        self.assertEqual(fp.getvalue(),
+                         json.dumps(self.sync.serialize(things), sort_keys=True, separators=(',', ':')))
+
     # Basic crud operations, not handling relationships beyond setting FKs
     # ------------------------------------------------------------------------
 
@@ -101,6 +183,23 @@ class ModelsTestCase(TestCase):
     def test_update_permission(self):
         self.sync(models.Thing, {'id': 1, 'user_id': 2, 'description': "blergh"}, user=self.user)
 
+    @raises(PermissionError)
+    def test_unknown_key(self):
+        # 'test' is a hybrid property, not a column or a relationship
+        self.sync(models.Thing, {'user_id': 1, 'description': "Hello.", 'test': 'yo'}, user=self.user)
+
+    def test_embedded_unknown_key(self):
+        # Rejected before the parent is created
+        with self.assertRaises(PermissionError):
+            self.sync(models.Thing, {'user_id': 1, 'description': "Hello.",
+                                     'children': [{'description': 'Foobar', 'nickname': 'Foo'}]},
+                      user=self.user)
+        self.assertEqual(len(self.db.session.new), 0)
+
+    @raises(PermissionError)
+    def test_null_to_one(self):
+        self.sync(models.Thing, {'id': 1, 'only_child': None}, user=self.user)
+
     # Relationship stuffs
     # ------------------------------------------------------------------------
 
@@ -126,7 +225,6 @@ class ModelsTestCase(TestCase):
                 'description': 'Foobar'
              }],
             'user_id': user.id,
-            'test': 'yo',
             'description': "Foobaz"
         }, user=user)
         old_id = old.children[0].id
@@ -269,6 +367,180 @@ class ModelsTestCase(TestCase):
         thing = models.Thing.query.filter_by(user_id=1).first()
         self.assertEqual(thing.children, [])
 
+    # Multi-column primary keys
+    # ------------------------------------------------------------------------
+
+    def test_composite_update(self):
+        thing = self.sync(models.Thing, {'id': 1, 'labels': [
+            {'thing_id': 1, 'name': 'red', 'color': 'crimson'},
+            {'thing_id': 1, 'name': 'blue', 'color': 'navy'},
+        ]}, user=self.user)
+        self.assertEqual(len(thing.labels), 2)
+
+        # Database step
+        self.assertEqual(models.ThingLabel.query.get((1, 'red')).color, 'crimson')
+        self.assertEqual(models.ThingLabel.query.get((1, 'blue')).color, 'navy')
+
+    def test_composite_create(self):
+        thing = self.sync(models.Thing, {'id': 2, 'labels': [
+            {'thing_id': 2, 'name': 'red', 'color': 'crimson'},
+        ]}, user=self.user)
+        self.assertEqual(thing.labels[0].name, 'red')
+
+        # Database step
+        self.assertEqual(models.ThingLabel.query.get((2, 'red')).color, 'crimson')
+        self.assertEqual(models.ThingLabel.query.get((1, 'red')).color, '#f00')
+
+    def test_composite_fk(self):
+        note = self.sync(models.LabelNote, {'thing_id': 1, 'label_name': 'red', 'text': 'Hi'}, user=self.user)
+        self.assertEqual(note.label.color, '#f00')
+
+    @raises(PermissionError)
+    def test_composite_fk_permission(self):
+        # The green label belongs to a thing owned by user ID 2
+        self.sync(models.LabelNote, {'thing_id': 3, 'label_name': 'green', 'text': 'Hi'}, user=self.user)
+
+    @raises(PermissionError)
+    def test_composite_partial_key(self):
+        self.sync(models.Thing, {'id': 1, 'labels': [{'thing_id': 1, 'color': 'crimson'}]}, user=self.user)
+
+    def test_composite_associate(self):
+        note = self.sync(models.LabelNote, {'text': 'Hi'}, user=self.user)
+        label = self.sync(models.ThingLabel, {'thing_id': 1, 'name': 'red', 'notes': [
+            {'id': note.id, '_op': 'associate'},
+        ]}, user=self.user)
+        self.assertEqual(label.notes[0].text, 'Hi')
+
+        # Database step
+        self.db.session.expire_all()
+        note = models.LabelNote.query.get(note.id)
+        self.assertEqual((note.thing_id, note.label_name), (1, 'red'))
+
+        label = self.sync(models.ThingLabel, {'thing_id': 1, 'name': 'red', 'notes': [
+            {'id': note.id, '_op': 'disassociate'},
+        ]}, user=self.user)
+        self.assertEqual(label.notes, [])
+
+        # Database step
+        self.db.session.expire_all()
+        note = models.LabelNote.query.get(note.id)
+        self.assertEqual((note.thing_id, note.label_name), (None, None))
+
+    @raises(PermissionError)
+    def test_composite_associate_permission(self):
+        # The green label belongs to a thing owned by user ID 2
+        note = self.sync(models.LabelNote, {'text': 'Hi'}, user=self.user)
+        self.sync(models.ThingLabel, {'thing_id': 3, 'name': 'green', 'notes': [
+            {'id': note.id, '_op': 'associate'},
+        ]}, user=self.user)
+
+    # SQL tracing
+    # ------------------------------------------------------------------------
+
+    def test_traced(self):
+        thing, report = self.sync.traced(models.Thing, {'id': 1, 'children': [{'description': 'Foobar'}]},
+                                         explain=True, user=self.user)
+        # The EXPLAINs ran after the commit, and left no transaction open behind them
+        self.assertEqual(self.db.session().transaction._connections, {})
+        self.assertEqual(thing.children[0].description, 'Foobar')
+        self.assertEqual(set(report['phases'].keys()), set(['resolve', 'flush', 'commit']))
+        inserts = [record for record in report['statements'] if record['statement'].startswith('INSERT')]
+        self.assertEqual(inserts[0]['mapper'], 'ChildThing')
+        self.assertEqual(inserts[0]['phase'], 'flush')
+        for entry in report['distinct']:
+            if entry['statement'] != 'COMMIT':
+                self.assertTrue('plan' in entry)
+
+    def test_traced_uncommitted(self):
+        # EXPLAIN runs inside the caller's open transaction, which must still be usable afterwards
+        thing, report = self.sync.traced(models.Thing, {'id': 1, 'description': 'Foo'},
+                                         explain=True, commit=False, user=self.user)
+        self.assertFalse('commit' in report['phases'])
+        self.sync(models.Thing, {'id': 1, 'children': [{'description': 'Bar'}]}, user=self.user)
+
+        # Database step
+        thing = models.Thing.query.get(1)
+        self.assertEqual(thing.description, 'Foo')
+        self.assertEqual(thing.children[0].description, 'Bar')
+
+    def test_traced_batched_lookup(self):
+        _, report = self.sync.traced(models.Thing, {'id': 1, 'children': [
+            {'id': 1, 'description': 'Foo'},
+            {'id': 3, 'description': 'Bar'},
+        ]}, user=self.user)
+        self.assertEqual(report['repeated_gets'], [])
+        self.assertEqual(report['duplicates'], [])
+
+    # Parallel apply
+    # ------------------------------------------------------------------------
+
+    def test_parallel_apply(self):
+        # WAL lets the workers write while the others read. It is stored in the database file, so
+        # switch back afterwards rather than run every later test in WAL mode.
+        self.db.engine.execute('PRAGMA journal_mode=WAL')
+        self.db.session.commit()
+        try:
+            parallel = ParallelMinisync(parallel_setup, processes=2)
+            results = parallel([
+                (models.Thing, {'id': 1, 'description': 'One'}),
+                (models.Thing, {'id': 2, 'description': 'Two'}),
+                (models.Thing, {'id': 1, 'user_id': 2}), # Not allowed; rolls back the first changeset too
+                (models.Thing, {'user_id': 1, 'description': 'Created'}),
+            ], load_user=parallel_load_user)
+
+            self.assertIsInstance(results[0][1], PartitionRolledBackError)
+            self.assertEqual(results[1][1], None)
+            self.assertIsInstance(results[2][1], PermissionError)
+            self.assertEqual(results[3][1], None)
+
+            # Database step
+            self.db.session.expire_all()
+            self.assertEqual(models.Thing.query.get(1).description, 'Foo')
+            self.assertEqual(models.Thing.query.get(2).description, 'Two')
+            self.assertEqual(models.Thing.query.filter_by(description='Created').count(), 1)
+        finally:
+            self.db.session.remove()
+            self.db.engine.execute('PRAGMA journal_mode=DELETE')
+
+    def test_parallel_apply_broken_serializer(self):
+        parallel = ParallelMinisync(parallel_broken_serializer_setup, processes=2)
+        results = parallel([
+            (models.Thing, {'id': 1, 'description': 'One'}),
+            (models.Thing, {'id': 2, 'description': 'Two'}),
+        ], load_user=parallel_load_user)
+        for result, error in results:
+            self.assertEqual(result, None)
+            self.assertTrue('Cannot serialize' in str(error))
+
+        # Database step: committed regardless
+        self.db.session.expire_all()
+        self.assertEqual(models.Thing.query.get(1).description, 'One')
+        self.assertEqual(models.Thing.query.get(2).description, 'Two')
+
+    def test_parallel_apply_broken_commit(self):
+        parallel = ParallelMinisync(parallel_broken_commit_setup, processes=2)
+        results = parallel([
+            (models.Thing, {'id': 1, 'description': 'One'}),
+            (models.Thing, {'id': 1, 'description': 'Uno'}),
+        ], load_user=parallel_load_user)
+        for result, error in results:
+            self.assertEqual(result, None)
+            self.assertTrue('Database is locked' in str(error))
+
+        # Database step
+        self.db.session.expire_all()
+        self.assertEqual(models.Thing.query.get(1).description, 'Foo')
+
+    def test_parallel_apply_broken_setup(self):
+        parallel = ParallelMinisync(parallel_broken_setup, processes=2)
+        results = parallel([
+            (models.Thing, {'id': 1, 'description': 'One'}),
+            (models.Thing, {'id': 2, 'description': 'Two'}),
+        ], load_user=parallel_load_user)
+        for result, error in results:
+            self.assertEqual(result, None)
+            self.assertTrue('No database configured' in str(error))
+
+
 if __name__ == '__main__':
     unittest.main()
-